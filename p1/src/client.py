@@ -12,15 +12,23 @@ import csv
 import pickle
 import socket
 import sys
+import time
 
+from _thread import allocate_lock
 from _thread import start_new_thread
 from collections import namedtuple
+from heapq import nsmallest
+from itertools import chain
 from os import getcwd
 from os.path import dirname
 from os.path import join
 from types import SimpleNamespace as sn
+from uuid import uuid4
+from utils.BloomFilter import BloomFilter
+from utils.HashRing import HashRing
 from utils.HashTable import HashEntry
 from utils.HashTable import HashTable
+from utils.PrefixIndex import PrefixIndex
 
 
 class Client:
@@ -34,20 +42,44 @@ class Client:
     ----------
     sock : socket.socket
         The socket object used for communication.
+    sock_lock : _thread.lock
+        Held while waiting on a response so threads don't take each other's responses.
     host_addr : tuple
         The address of the server.
     stat_file : str
         Path to stats file.
     hash_table : utils.HashTable.HashTable
         Client's portion of the DHT.
+    prefix_index : utils.PrefixIndex.PrefixIndex
+        Sorted keys of hash_table for prefix and fuzzy search.
     i : int
         Identifier for position in DHT.
     n : int
         Number of users in the ring.
+    users : list
+        All users in the ring, ordered by their id.
+    weights : dict
+        Maps the user_name of each user in the ring to its number of virtual nodes.
+    hash_ring : utils.HashRing.HashRing
+        Decides which user in the ring owns each key.
     prev : __main__.User
         The previous User.
     next : __main__.User
         The next User.
+    last_heartbeat : float
+        Time prev last acknowledged one of our heartbeats.
+    heartbeating : bool
+        True while the heartbeat thread is running.
+    repairing : bool
+        True while we are repairing the ring around a failed prev.
+    pending : dict
+        Maps broadcast ids to the state of broadcasts still waiting on acknowledgments.
+    load : int
+        Number of query messages handled since joining the ring.
+    epoch : int or None
+        Epoch of the DHT that dht_bloom was built for.
+    dht_bloom : utils.BloomFilter.BloomFilter or None
+        Filter over every key in the DHT, handed out by the server with query-dht.
 
     Parameters
     ----------
@@ -61,8 +93,16 @@ class Client:
 
     def __init__(self, host_ip, host_port, stat_file):
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.settimeout(SEGMENT_TIMEOUT)
+        self.sock_lock = allocate_lock()
         self.host_addr = (host_ip, host_port)
         self.stat_file = stat_file
+        self.pending = {}
+        self.seq = 0
+        self.epoch = None
+        self.dht_bloom = None
+        self.heartbeating = False
+        self.repairing = False
 
         self.display_help()
         while True:
@@ -87,7 +127,7 @@ class Client:
             s.connect(("8.8.8.8", 80))
             sock.bind((s.getsockname()[0], port))
         while True:
-            raw_bytes, addr = sock.recvfrom(1024)
+            raw_bytes, addr = sock.recvfrom(BUF_SIZE)
             data = pickle.loads(raw_bytes)
             self.handle_segment(data)
 
@@ -96,6 +136,9 @@ class Client:
         Used for sending something when a response is expected. This will send a
         pickle of the payload to the specified address. It will then wait for a response.
         payload should be a SimpleNamespace for it to comply with the message format.
+        Each payload is tagged with a sequence number that the response echoes, so a
+        late response to an earlier payload is discarded rather than mistaken for this
+        one. If nothing comes back within SEGMENT_TIMEOUT seconds a FAILURE is returned.
 
         Parameters
         ----------
@@ -109,8 +152,19 @@ class Client:
         types.SimpleNamespace
             SimpleNamespace containing a status code and a body which could be anything.
         '''
-        self.sock.sendto(pickle.dumps(payload), addr)
-        response = pickle.loads(self.sock.recv(1024))
+        with self.sock_lock:
+            self.seq += 1
+            payload.seq = self.seq
+            self.sock.sendto(pickle.dumps(payload), addr)
+            deadline = time.time() + SEGMENT_TIMEOUT
+            try:
+                while True:
+                    self.sock.settimeout(max(deadline - time.time(), 0.001))
+                    response = pickle.loads(self.sock.recv(BUF_SIZE))
+                    if response.seq == payload.seq:
+                        break
+            except socket.timeout:
+                response = sn(status=FAILURE, body=f'No response to {payload.command}.')
         print(f'{response.status} ({payload.command})')
         return response
 
@@ -124,20 +178,22 @@ class Client:
         data : types.SimpleNamespace
             The data that has been received.
         '''
-        if data.command == 'set-id':
-            self.set_id(**data.args.__dict__)
+        if data.command == 'broadcast':
+            self.handle_broadcast(seq=data.seq, **data.args.__dict__)
+        elif data.command == 'broadcast-ack':
+            self.broadcast_ack(**data.args.__dict__)
         elif data.command == 'store':
-            self.store(**data.args.__dict__)
+            if hasattr(self, 'hash_table'):
+                self.store(**data.args.__dict__)
         elif data.command == 'query':
-            self.query(**data.args.__dict__)
-        elif data.command == 'reset-id':
-            self.reset_id(**data.args.__dict__)
-        elif data.command == 'reset-left':
-            self.next = data.args.next_user
-        elif data.command == 'reset_right':
-            self.prev = data.args.prev_user
-        elif data.command == 'teardown':
-            self.teardown()
+            if hasattr(self, 'hash_table'):
+                self.query(seq=data.seq, **data.args.__dict__)
+        elif data.command == 'heartbeat':
+            payload = sn(command='heartbeat-ack', args=sn(user_name=data.args.user_name))
+            self.sock.sendto(pickle.dumps(payload), data.args.reply_addr)
+        elif data.command == 'heartbeat-ack':
+            if hasattr(self, 'prev') and data.args.user_name == self.prev.user_name:
+                self.last_heartbeat = time.time()
 
     def interpret_command(self, command):
         '''
@@ -158,12 +214,18 @@ class Client:
                 self.setup_dht(*command_split[1:])
             elif command_split[0] == 'query-dht':
                 self.query_dht(' '.join(command_split[1:]))
+            elif command_split[0] == 'search-dht':
+                self.search_dht(' '.join(command_split[1:]))
             elif command_split[0] == 'leave-dht':
                 self.leave_dht()
             elif command_split[0] == 'deregister':
                 self.deregister()
             elif command_split[0] == 'teardown-dht':
                 self.teardown_dht()
+            elif command_split[0] == 'rebalance-dht':
+                self.rebalance_dht(*command_split[1:])
+            elif command_split[0] == 'report-dht':
+                self.report_dht()
             else:
                 print("Command not understood, try again.")
 
@@ -174,11 +236,14 @@ class Client:
         print('\nAvailable commands:')
         print('help')
         print('register <user-name> <port>')
-        print('setup-dht <n>')
+        print('setup-dht <n> [vnodes]')
         print('query-dht <long-name>')
+        print('search-dht <text>')
         print('leave-dht')
         print('deregister')
-        print('teardown-dht\n')
+        print('teardown-dht')
+        print('rebalance-dht <user-name> <vnodes>')
+        print('report-dht\n')
 
     def register(self, user_name, port):
         '''
@@ -199,7 +264,7 @@ class Client:
         if response.status == SUCCESS:
             start_new_thread(self.listen, (int(port),))
 
-    def setup_dht(self, n):
+    def setup_dht(self, n, vnodes=None):
         '''
         Asks server for n-1 other free users then constructs a ring structure and builds
         a DHT amongst the n nodes.
@@ -208,42 +273,178 @@ class Client:
         ----------
         n : int
             Number of nodes in the DHT, cannot exceed number of free users.
+        vnodes : int (optional)
+            Number of virtual nodes each user starts with, VNODES if not given.
         '''
+        vnodes = VNODES if vnodes is None else int(vnodes)
+        if vnodes < 1:
+            print('Each user needs at least 1 vnode.')
+            return
         response = self.send_segment(sn(command='setup-dht', args=sn(n=int(n),)), self.host_addr)
         if response.status == SUCCESS:
-            n = len(response.body)
-            self.set_id(0, n, response.body[-1 % n], response.body[1])
-            for i in range(1, n):
-                payload = sn(command='set-id', args=sn(i=i, n=n, prev=response.body[(i-1) % n], next=response.body[(i+1) % n]))
-                self.sock.sendto(pickle.dumps(payload), response.body[i].recv_addr)
-            # Read Stats File
-            with open(self.stat_file) as f:
-                reader = csv.DictReader(f)
-                for row in reader:
-                    self.store(dict(row))
+            users = response.body
+            weights = {user.user_name: vnodes for user in users}
+            built = self.broadcast('set-id', users, users[0].out_addr, sn(weights=weights)).status == SUCCESS
+            if built:
+                bloom = self.store_stats_file(users, weights)
+            else:
+                # Undo the setup on every user it reached
+                self.broadcast('teardown', users, users[0].out_addr)
+                bloom = None
             # All done
-            self.send_segment(sn(command='dht-complete', args=None), self.host_addr)
+            payload = sn(command='dht-complete', args=sn(built=built, weights=weights, bloom=bloom))
+            self.send_segment(payload, self.host_addr)
 
-    def set_id(self, i, n, prev, next):
+    def store_stats_file(self, users, weights, key_filter=None):
         '''
-        Sets instance variables relating to the DHT. Clears the hash table.
+        Reads the stats file and sends every record straight to the user that owns it,
+        rather than along the ring where one user would have to forward all of them.
+        Every record passes through us, so we also build the bloom filter for the whole DHT.
+
+        Parameters
+        ----------
+        users : list
+            All users in the ring, ordered by their id.
+        weights : dict
+            Maps the user_name of each user in the ring to its number of virtual nodes.
+        key_filter : function (optional)
+            Only records whose Long Name it returns True for are stored, every record
+            is stored if it isn't given.
+
+        Returns
+        -------
+        utils.BloomFilter.BloomFilter
+            Filter over every key stored.
+        '''
+        hash_ring = HashRing([user.user_name for user in users], weights)
+        bloom = BloomFilter(size=BLOOM_SIZE, num_hashes=BLOOM_HASHES)
+        with open(self.stat_file) as f:
+            reader = csv.DictReader(f)
+            for row in reader:
+                if key_filter is not None and not key_filter(row['Long Name']):
+                    continue
+                owner = users[hash_ring.lookup(row['Long Name'])]
+                self.sock.sendto(pickle.dumps(sn(command='store', args=sn(record=dict(row)))), owner.recv_addr)
+                bloom.add(row['Long Name'])
+        return bloom
+
+    def set_id(self, i, users, weights):
+        '''
+        Sets instance variables relating to the DHT. Clears the hash table,
+        the count of queries handled is kept until we leave the DHT.
 
         Parameters
         ----------
         i : int
             Identifier for position in DHT.
-        n : int
-            Number of users in the ring.
-        prev : __main__.User
-            The previous User.
-        next : __main__.User
-            The next User.
+        users : list
+            All users in the ring, ordered by their id.
+        weights : dict
+            Maps the user_name of each user in the ring to its number of virtual nodes.
         '''
-        self.i = i
-        self.n = n
-        self.prev = prev
-        self.next = next
+        self.relink(i, users, weights)
         self.hash_table = HashTable(size=HASH_SIZE)
+        self.prefix_index = PrefixIndex()
+        if not hasattr(self, 'load'):
+            self.load = 0
+
+    def relink(self, i, users, weights):
+        '''
+        Sets instance variables relating to the shape of the ring, keeping the hash
+        table. Starts the heartbeat thread if it isn't running.
+
+        Parameters
+        ----------
+        i : int
+            Identifier for position in DHT.
+        users : list
+            All users in the ring, ordered by their id.
+        weights : dict
+            Maps the user_name of each user in the ring to its number of virtual nodes.
+        '''
+        self.i = i
+        self.n = len(users)
+        self.users = users
+        self.weights = weights
+        self.hash_ring = HashRing([user.user_name for user in users], weights)
+        self.prev = users[(i-1) % self.n]
+        self.next = users[(i+1) % self.n]
+        self.last_heartbeat = time.time()
+        if not self.heartbeating:
+            self.heartbeating = True
+            start_new_thread(self.heartbeat, ())
+
+    def heartbeat(self):
+        '''
+        Runs as long as we are in the DHT. Sends a heartbeat to prev every HEARTBEAT_INTERVAL
+        seconds, which any live user acknowledges, even one no longer in the DHT. If prev
+        hasn't acknowledged in HEARTBEAT_TIMEOUT seconds a thread is spawned to repair the
+        ring, so our own heartbeats keep going in the meantime.
+        '''
+        try:
+            while True:
+                payload = sn(command='heartbeat', args=sn(user_name=self.prev.user_name,
+                                                          reply_addr=self.users[self.i].recv_addr))
+                self.sock.sendto(pickle.dumps(payload), self.prev.recv_addr)
+                if time.time() - self.last_heartbeat > HEARTBEAT_TIMEOUT and not self.repairing:
+                    self.repairing = True
+                    start_new_thread(self.repair, (self.prev, time.time()))
+                time.sleep(HEARTBEAT_INTERVAL)
+        except AttributeError:
+            # DHT attributes were deleted, we are no longer in the DHT
+            self.heartbeating = False
+
+    def repair(self, failed, detected):
+        '''
+        Reports a failed prev to the server. If the server agrees, it sends back the ring
+        as it knows it along with every user reported failed so far. The ring is re-linked
+        around the failed users and only the keys they owned are reloaded from the stats
+        file, every other key stays where it is. The reloaded keys are sent straight to
+        their new owner rather than along the ring. If the re-link doesn't reach every user
+        another user must have failed too. The server isn't told the ring was rebuilt, and we
+        adopt the re-linked ring ourselves so the heartbeat thread goes on to report the
+        user before the failed ones. Prints the time from the first detection of any of the
+        failed users to recovery, however many attempts it took.
+
+        Parameters
+        ----------
+        failed : __main__.User
+            The user that stopped sending heartbeats.
+        detected : float
+            Time the failure was detected.
+        '''
+        try:
+            response = self.send_segment(sn(command='node-failed', args=sn(failed=failed)), self.host_addr)
+            if response.status == SUCCESS:
+                # An earlier attempt may have been made by another user
+                detected = min(detected, time.time() - response.body.waited)
+                old_users = response.body.users
+                old_ring = HashRing([user.user_name for user in old_users], response.body.weights)
+                failed_ids = {old_users.index(user) for user in response.body.failed}
+                users = [user for user in old_users if user not in response.body.failed]
+                weights = {user.user_name: response.body.weights[user.user_name] for user in users}
+                me = self.users[self.i]
+                relinked = self.broadcast('relink', users, me.out_addr, sn(weights=weights)).status == SUCCESS
+                if relinked:
+                    self.store_stats_file(users, weights, lambda key: old_ring.lookup(key) in failed_ids)
+                else:
+                    self.relink(users.index(me), users, weights)
+                payload = sn(command='repair-complete', args=sn(relinked=relinked, weights=weights))
+                self.send_segment(payload, self.host_addr)
+                if relinked:
+                    print(f'Recovered from failure of {failed.user_name} in {time.time() - detected:.3f}s')
+        finally:
+            self.repairing = False
+
+    def drop_moved_keys(self):
+        '''
+        Removes the records we no longer own from the hash table and prefix index,
+        whoever owns them now is sent them separately.
+        '''
+        for record in list(self.hash_table):
+            if self.hash_ring.lookup(record['Long Name']) != self.i:
+                self.hash_table.remove(record['Long Name'])
+                self.prefix_index.remove(record['Long Name'])
 
     def del_dht_attrs(self):
         '''
@@ -251,23 +452,186 @@ class Client:
         '''
         del self.i
         del self.n
+        del self.users
+        del self.weights
+        del self.hash_ring
         del self.prev
         del self.next
+        del self.last_heartbeat
         del self.hash_table
+        del self.prefix_index
+        del self.load
+
+    def broadcast(self, command, users, reply_addr, args=None):
+        '''
+        Fans a command out over a spanning tree of the ring rooted at users[0], then
+        waits for the single acknowledgment the root sends once the whole tree has
+        handled it. Takes O(log n) round trips rather than one per user. If some user
+        didn't handle it the response is a FAILURE.
+
+        Parameters
+        ----------
+        command : str
+            The name of the command every user in the ring should handle.
+        users : list
+            All users in the ring, ordered by their id.
+        reply_addr : tuple
+            Our out_addr as the server sees it, where the root sends its acknowledgment.
+        args : types.SimpleNamespace (optional)
+            Additional data relevant to the command.
+
+        Returns
+        -------
+        types.SimpleNamespace
+            Response from the root, its body maps the user_name of each user that handled
+            the command to that user's reply.
+        '''
+        payload = sn(command='broadcast', args=sn(bid=uuid4().hex, command=command, args=args, users=users,
+                                                  lo=0, hi=len(users), parent=None, reply_addr=reply_addr))
+        return self.send_segment(payload, users[0].recv_addr)
+
+    def handle_broadcast(self, bid, command, args, users, lo, hi, parent, reply_addr, seq):
+        '''
+        Handles the broadcast command as users[lo], then splits the rest of the range
+        [lo, hi) in half and forwards the broadcast to the first user of each half.
+        Replies are collected until both children have acknowledged, or until the
+        subtree times out. A subtree's timeout grows with its height so it always times
+        out after the subtrees below it.
+
+        Parameters
+        ----------
+        bid : str
+            Unique identifier of the broadcast.
+        command : str
+            The name of the command being broadcast.
+        args : types.SimpleNamespace
+            Additional data relevant to the command.
+        users : list
+            All users in the ring, ordered by their id.
+        lo : int
+            Our id, the first id in the range of users this subtree covers.
+        hi : int
+            One past the last id in the range of users this subtree covers.
+        parent : __main__.User or None
+            User to acknowledge once the subtree is done, None if we are the root.
+        reply_addr : tuple
+            Address of the user who started the broadcast.
+        seq : int
+            Sequence number of the broadcast payload, echoed by the root's response.
+        '''
+        reply = None
+        # Only set-id and teardown make sense for a user that isn't in the DHT
+        complete = hasattr(self, 'hash_table') or command in ('set-id', 'reset-id', 'teardown')
+        if command in ('set-id', 'reset-id'):
+            self.set_id(lo, users, args.weights)
+        elif not complete:
+            pass
+        elif command == 'relink':
+            self.relink(lo, users, args.weights)
+            self.drop_moved_keys()
+        elif command == 'report':
+            reply = sn(vnodes=self.weights[users[lo].user_name], keys=len(self.hash_table), queries=self.load)
+        elif command == 'search':
+            reply = self.prefix_index.search(args.query, args.limit, args.max_distance)
+        elif command == 'teardown' and hasattr(self, 'users'):
+            self.del_dht_attrs()
+        replies = {users[lo].user_name: reply} if complete else {}
+        self.pending[bid] = sn(waiting=0, complete=complete, replies=replies, parent=parent, reply_addr=reply_addr,
+                               user_name=users[lo].user_name, command=command, args=args, seq=seq)
+        mid = lo + 1 + (hi - lo) // 2
+        for child_lo, child_hi in ((lo+1, mid), (mid, hi)):
+            if child_lo < child_hi:
+                self.pending[bid].waiting += 1
+                payload = sn(command='broadcast', seq=seq, args=sn(bid=bid, command=command, args=args, users=users,
+                                                                   lo=child_lo, hi=child_hi, parent=users[lo],
+                                                                   reply_addr=reply_addr))
+                self.sock.sendto(pickle.dumps(payload), users[child_lo].recv_addr)
+        if self.pending[bid].waiting == 0:
+            self.finish_broadcast(bid)
+        else:
+            start_new_thread(self.expire_broadcast, (bid, BROADCAST_TIMEOUT * (hi - lo).bit_length()))
+
+    def broadcast_ack(self, bid, replies, complete):
+        '''
+        Records an acknowledgment from a child in the broadcast tree. Acknowledgments
+        arriving after the broadcast timed out are dropped.
+
+        Parameters
+        ----------
+        bid : str
+            Unique identifier of the broadcast.
+        replies : dict
+            Maps each user_name in the child's subtree to that user's reply.
+        complete : bool
+            False if some user in the child's subtree didn't acknowledge.
+        '''
+        pending = self.pending.get(bid)
+        if pending is None:
+            return
+        pending.replies.update(replies)
+        pending.complete = pending.complete and complete
+        pending.waiting -= 1
+        if pending.waiting == 0:
+            self.finish_broadcast(bid)
+
+    def expire_broadcast(self, bid, timeout):
+        '''
+        Finishes a broadcast with whatever replies it has if its children haven't all
+        acknowledged within timeout seconds.
+
+        Parameters
+        ----------
+        bid : str
+            Unique identifier of the broadcast.
+        timeout : float
+            Seconds to wait for the children.
+        '''
+        time.sleep(timeout)
+        pending = self.pending.get(bid)
+        if pending is not None:
+            pending.complete = False
+            self.finish_broadcast(bid)
+
+    def finish_broadcast(self, bid):
+        '''
+        Passes the replies of a finished subtree up to the parent. The root instead
+        sends a response to the user who started the broadcast, a SUCCESS only if every
+        user acknowledged. Search results are merged first so only the best of the
+        subtree are passed up.
+
+        Parameters
+        ----------
+        bid : str
+            Unique identifier of the broadcast.
+        '''
+        pending = self.pending.pop(bid, None)
+        if pending is None:
+            # The acknowledgments and the timeout raced, the other one finished it
+            return
+        if pending.command == 'search':
+            results = nsmallest(pending.args.limit, chain.from_iterable(pending.replies.values()))
+            pending.replies = {pending.user_name: results}
+        if pending.parent is None:
+            status = SUCCESS if pending.complete else FAILURE
+            self.sock.sendto(pickle.dumps(sn(status=status, body=pending.replies, seq=pending.seq)), pending.reply_addr)
+        else:
+            payload = sn(command='broadcast-ack', args=sn(bid=bid, replies=pending.replies, complete=pending.complete))
+            self.sock.sendto(pickle.dumps(payload), pending.parent.recv_addr)
 
     def store(self, record):
         '''
-        If the id computed by the hash is our id then the record will be added
-        to the hash table, otherwise it will be sent along the chain.
+        If the id computed by the hash is our id then the record will be added to the
+        hash table and prefix index, otherwise it will be sent along the chain.
 
         Parameters
         ----------
         record : dict
             dictionary mapping each field associated with a particular country to its value.
         '''
-        id = self.hash_table.hash_func(record['Long Name']) % self.n
+        id = self.hash_ring.lookup(record['Long Name'])
         if self.i == id:
             self.hash_table.add(record)
+            self.prefix_index.add(record['Long Name'])
         else:
             payload = sn(command='store', args=sn(record=record))
             self.sock.sendto(pickle.dumps(payload), self.next.recv_addr)
@@ -276,22 +640,58 @@ class Client:
         '''
         Sends request to server to query, on a successful response it will go around the ring
         looking for who has the long_name that was queried. If found it will be printed.
+        The hash of long_name is sent so the server can start the query at its owner.
+        If long_name is not in the DHT's bloom filter it can't be in the DHT, so the
+        ring is never queried.
 
         Parameters
         ----------
         long_name : str
             Long Name of Country to query DHT.
         '''
-        response = self.send_segment(sn(command='query-dht', args=None), self.host_addr)
+        key_hash = HashRing.hash_func(long_name)
+        payload = sn(command='query-dht', args=sn(key_hash=key_hash, epoch=self.epoch))
+        response = self.send_segment(payload, self.host_addr)
         if response.status == SUCCESS:
+            # The server only sends the filter when ours is out of date
+            if response.body.bloom is not None:
+                self.epoch = response.body.epoch
+                self.dht_bloom = response.body.bloom
+            if long_name not in self.dht_bloom:
+                print(f'Long name, {long_name}, could not be found in the DHT.')
+                return
             payload = sn(command='query', args=sn(long_name=long_name, u_addr=self.sock.getsockname()))
-            record = self.send_segment(payload, response.body.recv_addr).body
-            print(record)
+            response = self.send_segment(payload, response.body.user.recv_addr)
+            print(response.body)
+
+    def search_dht(self, text):
+        '''
+        Sends request to server to search, on a successful response the search is broadcast
+        to every user in the ring. Each user finds the Long Names in its part of the DHT that
+        start with text or are close misspellings of it. The closest SEARCH_LIMIT are printed.
+        If some users don't answer in time, the results of those that did are still printed.
+
+        Parameters
+        ----------
+        text : str
+            Prefix or misspelling of a Long Name.
+        '''
+        response = self.send_segment(sn(command='search-dht', args=None), self.host_addr)
+        if response.status == SUCCESS:
+            args = sn(query=text, limit=SEARCH_LIMIT, max_distance=SEARCH_DISTANCE)
+            response = self.broadcast('search', response.body.users, response.body.user.out_addr, args)
+            # The root answers with the results it has even if some subtree timed out
+            if isinstance(response.body, dict):
+                if response.status == FAILURE:
+                    print('Not every user answered, some Long Names may be missing.')
+                for distance, long_name in sorted(chain.from_iterable(response.body.values())):
+                    print(f'{long_name} (distance {distance})')
 
-    def query(self, long_name, u_addr):
+    def query(self, long_name, u_addr, seq):
         '''
         If the id computed by the hash is our id then send it back to the user that
-        queried, otherwise the command will be sent along the chain.
+        queried, otherwise the command will be sent along the chain. Every user the
+        query passes through counts it towards its load.
 
         Parameters
         ----------
@@ -299,53 +699,46 @@ class Client:
             Long Name of Country to query DHT.
         u_addr : tuple
             Address of the user who issued the query.
+        seq : int
+            Sequence number of the query payload, echoed by the response.
         '''
-        id = self.hash_table.hash_func(long_name) % self.n
+        self.load += 1
+        id = self.hash_ring.lookup(long_name)
         if self.i == id:
             record = self.hash_table.lookup(long_name)
             if record is not None:
-                self.sock.sendto(pickle.dumps(sn(status=SUCCESS, body=record)), u_addr)
+                self.sock.sendto(pickle.dumps(sn(status=SUCCESS, body=record, seq=seq)), u_addr)
             else:
                 err_msg = f'Long name, {long_name}, could not be found in the DHT.'
-                self.sock.sendto(pickle.dumps(sn(status=FAILURE, body=err_msg)), u_addr)
+                self.sock.sendto(pickle.dumps(sn(status=FAILURE, body=err_msg, seq=seq)), u_addr)
         else:
-            payload = sn(command='query', args=sn(long_name=long_name, u_addr=u_addr))
+            payload = sn(command='query', seq=seq, args=sn(long_name=long_name, u_addr=u_addr))
             self.sock.sendto(pickle.dumps(payload), self.next.recv_addr)
 
     def leave_dht(self):
         '''
-        Asks the server to leave, Tells all the other nodes to reset their ids,
-        reconnects left and right neighbors, rebuilds dht, tells the server.
+        Asks the server to leave, broadcasts the new ring without us to all other nodes,
+        rebuilds dht, tells the server.
         '''
         response = self.send_segment(sn(command='leave-dht', args=None), self.host_addr)
         if response.status == SUCCESS:
-            # Restucture DHT
-            self.send_segment(sn(command='reset-id', args=sn(i=0, n=self.n-1)), self.next.recv_addr)
-            self.sock.sendto(pickle.dumps(sn(command='reset-left', args=sn(next_user=self.next))), self.prev.recv_addr)
-            self.sock.sendto(pickle.dumps(sn(command='reset-right', args=sn(prev_user=self.prev))), self.next.recv_addr)
-            # Rebuild the DHT
-            with open(self.stat_file) as f:
-                reader = csv.DictReader(f)
-                for row in reader:
-                    self.sock.sendto(pickle.dumps(sn(command='store', args=sn(record=dict(row)))), self.next.recv_addr)
+            # Restucture DHT, the user after us becomes the new leader
+            users = self.users[self.i+1:] + self.users[:self.i]
+            weights = {user.user_name: self.weights[user.user_name] for user in users}
+            me = self.users[self.i]
+            rebuilt = self.broadcast('reset-id', users, me.out_addr, sn(weights=weights)).status == SUCCESS
+            if rebuilt:
+                # Rebuild the DHT
+                bloom = self.store_stats_file(users, weights)
+            else:
+                # Put back the DHT we were leaving on every user it reached
+                self.broadcast('set-id', self.users, me.out_addr, sn(weights=self.weights))
+                bloom = self.store_stats_file(self.users, self.weights)
             # Tell the server who the new leader is
-            self.send_segment(sn(command='dht-rebuilt', args=sn(leader=self.next)), self.host_addr)
-            self.del_dht_attrs()
-
-    def reset_id(self, i, n):
-        '''
-        Updates i and n values and sends message around the ring until it comes
-        back to the user that is leaving.
-        '''
-        self.i = i
-        self.n = n
-        self.hash_table = HashTable(size=HASH_SIZE)
-        # If the next the user is leaving the DHT
-        if i == n - 1:
-            self.sock.sendto(pickle.dumps(sn(status=SUCCESS, body=None)), self.next.out_addr)
-        else:
-            payload = sn(command='reset-id', args=sn(i=i+1, n=n))
-            self.sock.sendto(pickle.dumps(payload), self.next.recv_addr)
+            args = sn(rebuilt=rebuilt, leader=self.next, weights=weights, bloom=bloom)
+            self.send_segment(sn(command='dht-rebuilt', args=args), self.host_addr)
+            if rebuilt:
+                self.del_dht_attrs()
 
     def deregister(self):
         '''
@@ -357,30 +750,78 @@ class Client:
 
     def teardown_dht(self):
         '''
-        Tears down the DHT completely for all users.
+        Tears down the DHT completely for all users. We only leave the DHT ourselves
+        once every other user has, so the teardown can be retried if it didn't reach
+        all of them.
         '''
         response = self.send_segment(sn(command='teardown-dht', args=None), self.host_addr)
         if response.status == SUCCESS:
-            payload = sn(command='teardown', args=None)
-            self.send_segment(payload, self.next.recv_addr)
+            me = self.users[self.i]
+            others = [user for user in self.users if user != me]
+            torn_down = not others or self.broadcast('teardown', others, me.out_addr).status == SUCCESS
             # All done
-            self.send_segment(sn(command='teardown-complete', args=None), self.host_addr)
+            self.send_segment(sn(command='teardown-complete', args=sn(torn_down=torn_down)), self.host_addr)
+            if torn_down:
+                self.del_dht_attrs()
 
-    def teardown(self):
+    def rebalance_dht(self, user_name, vnodes):
         '''
-        Message send around the DHT deleting all DHT attributes until it gets
-        back to the leader.
+        Changes the number of virtual nodes of a user in the ring so the user's share of
+        the keys grows or shrinks to match. The ring is re-linked with the new weights,
+        then only the keys whose owner changed are reloaded from the stats file, every
+        other key stays where it is. Only the leader may rebalance.
+
+        Parameters
+        ----------
+        user_name : str
+            Name of the user to reweight.
+        vnodes : int
+            New number of virtual nodes of the user, must be at least 1.
         '''
-        if self.i == 0:
-            self.sock.sendto(pickle.dumps(sn(status=SUCCESS, body=None)), self.sock.getsockname())
-        else:
-            payload = sn(command='teardown', args=None)
-            self.sock.sendto(pickle.dumps(payload), self.next.recv_addr)
-        self.del_dht_attrs()
+        payload = sn(command='rebalance-dht', args=sn(user_name=user_name, vnodes=int(vnodes)))
+        response = self.send_segment(payload, self.host_addr)
+        if response.status == SUCCESS:
+            users, me = self.users, self.users[self.i]
+            old_weights, old_ring = self.weights, self.hash_ring
+            weights = dict(old_weights)
+            weights[user_name] = int(vnodes)
+            hash_ring = HashRing([user.user_name for user in users], weights)
+            rebuilt = self.broadcast('relink', users, me.out_addr, sn(weights=weights)).status == SUCCESS
+            if not rebuilt:
+                # Put back the old weights on every user it reached
+                self.broadcast('relink', users, me.out_addr, sn(weights=old_weights))
+                weights, old_ring, hash_ring = old_weights, hash_ring, old_ring
+            self.store_stats_file(users, weights, lambda key: old_ring.lookup(key) != hash_ring.lookup(key))
+            payload = sn(command='dht-rebuilt', args=sn(rebuilt=rebuilt, leader=users[0], weights=weights))
+            self.send_segment(payload, self.host_addr)
+
+    def report_dht(self):
+        '''
+        Prints the number of virtual nodes, keys stored and queries handled by each user
+        in the ring.
+        '''
+        if not hasattr(self, 'users'):
+            print('Must be in the DHT to report on it.')
+            return
+        response = self.broadcast('report', self.users, self.users[self.i].out_addr)
+        if response.status == SUCCESS:
+            for user in self.users:
+                reply = response.body[user.user_name]
+                print(f'{user.user_name}: {reply.vnodes} vnodes, {reply.keys} keys, {reply.queries} queries')
 
 SUCCESS = 'SUCCESS'
 FAILURE = 'FAILURE'
+BLOOM_HASHES = 4
+BLOOM_SIZE = 2048
+BROADCAST_TIMEOUT = 0.5
+BUF_SIZE = 65507
 HASH_SIZE = 353
+HEARTBEAT_INTERVAL = 1
+HEARTBEAT_TIMEOUT = 3
+SEARCH_DISTANCE = 2
+SEARCH_LIMIT = 10
+SEGMENT_TIMEOUT = 5
+VNODES = 16
 User = namedtuple('User', 'user_name out_addr recv_addr')
 
 if __name__ == '__main__':
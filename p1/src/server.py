@@ -8,18 +8,27 @@ Description : This script represents a server process. Clients send commands to
               server.
 '''
 import argparse
+import copy
 import pickle
 import random
 import socket
+import time
 
 from collections import namedtuple
+from os import getcwd
+from os.path import dirname
+from os.path import join
 from types import SimpleNamespace as sn
+from utils.HashRing import HashRing
+from utils.StateLog import StateLog
+from utils.StateLog import apply_op
 
 
 class Server:
     '''
     The server class holds state information about clients and responds to requests
-    from the clients.
+    from the clients. Every change to the state in LOGGED_STATE is appended to a
+    write-ahead log first, so a restarted server picks up where it left off.
 
     Attributes
     ----------
@@ -29,21 +38,51 @@ class Server:
         Maps user_name to their staet {'Free', 'InDHT', 'Leader'}.
     num_DHTs : int
         Number of DHT's constructed, should be limited to 1.
+    ring : list
+        user_names of the users in the DHT ordered by their id.
+    weights : dict
+        Maps the user_name of each user in the DHT to its number of virtual nodes.
+    hash_ring : utils.HashRing.HashRing or None
+        Decides which user in the DHT owns each key.
+    failed : set
+        user_names reported failed whose repair hasn't reached every user yet.
+    failed_at : float or None
+        Time the first of the failed users was reported.
+    epoch : int
+        Incremented every time the DHT is built, rebuilt or torn down.
+    bloom : utils.BloomFilter.BloomFilter or None
+        Filter over every key in the DHT, handed out to queriers.
+    wal : utils.StateLog.StateLog
+        Write-ahead log of state transitions.
     sock : socket.socket
         The socket object used for communication.
     out_addr : tuple
         Address of the last client we've recieved a message from.
+    seq : int
+        Sequence number of the last message received, echoed by our response to it.
 
     Parameters
     ----------
     port : int
         Port to listen on.
+    state_dir : str
+        Directory holding the write-ahead log.
     '''
 
-    def __init__(self, port):
+    def __init__(self, port, state_dir):
         self.users = {}
         self.state = {}
         self.num_DHTs = 0
+        self.ring = []
+        self.weights = {}
+        self.hash_ring = None
+        self.failed = set()
+        self.failed_at = None
+        self.seq = None
+        self.epoch = 0
+        self.bloom = None
+        self.wal = StateLog(state_dir, compact_every=COMPACT_EVERY)
+        self.recover()
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         try:
             self.sock.bind((socket.gethostname(), port))
@@ -52,16 +91,49 @@ class Server:
             s.connect(("8.8.8.8", 80))
             self.sock.bind((s.getsockname()[0], port))
         while True:
-            bytes, self.out_addr = self.sock.recvfrom(1024)
+            bytes, self.out_addr = self.sock.recvfrom(BUF_SIZE)
             print('Received data from', self.out_addr)
             data = pickle.loads(bytes)
+            self.seq = data.seq
             self.handle_segment(data)
 
+    def recover(self):
+        '''
+        Restores the state from the latest snapshot in the write-ahead log and replays
+        the transitions logged after it.
+        '''
+        start = time.time()
+        state, records = self.wal.load()
+        for attr, value in (state or {}).items():
+            setattr(self, attr, value)
+        for record in records:
+            for op in record:
+                apply_op(self, op)
+        self.hash_ring = HashRing(self.ring, self.weights) if self.ring else None
+        print(f'Recovered {len(self.users)} users from {len(records)} log records in {time.time() - start:.3f}s')
+
+    def commit(self, *ops):
+        '''
+        Appends a state transition to the write-ahead log then applies it. Once enough
+        transitions have been logged the log is compacted in the background, the state
+        is only copied if a snapshot isn't already being written.
+
+        Parameters
+        ----------
+        ops : tuple
+            Operations making up the transition, see utils.StateLog.apply_op.
+        '''
+        self.wal.append(list(ops))
+        for op in ops:
+            apply_op(self, op)
+        if self.wal.records >= self.wal.compact_every and not self.wal.compacting:
+            self.wal.compact({attr: copy.copy(getattr(self, attr)) for attr in LOGGED_STATE})
+
     def failure(self):
         '''
         Sends a FAILURE response to self.out_addr.
         '''
-        self.sock.sendto(pickle.dumps(sn(status=FAILURE, body=None)), self.out_addr)
+        self.sock.sendto(pickle.dumps(sn(status=FAILURE, body=None, seq=self.seq)), self.out_addr)
 
     def success(self, body=None):
         '''
@@ -72,7 +144,7 @@ class Server:
         body : any
             Data relevant to response.
         '''
-        self.sock.sendto(pickle.dumps(sn(status=SUCCESS, body=body)), self.out_addr)
+        self.sock.sendto(pickle.dumps(sn(status=SUCCESS, body=body, seq=self.seq)), self.out_addr)
 
     def lookup(self, user=None):
         '''
@@ -116,9 +188,10 @@ class Server:
             data recieved with the command.
         '''
         while True:
-            bytes, self.out_addr = self.sock.recvfrom(1024)
+            bytes, self.out_addr = self.sock.recvfrom(BUF_SIZE)
             print('Received data from', self.out_addr)
             data = pickle.loads(bytes)
+            self.seq = data.seq
             if data.command == command and self.lookup() == user:
                 self.success()
                 return data
@@ -140,13 +213,43 @@ class Server:
         elif data.command == 'setup-dht':
             self.setup_dht(**data.args.__dict__)
         elif data.command == 'query-dht':
-            self.query_dht()
+            self.query_dht(**data.args.__dict__)
+        elif data.command == 'search-dht':
+            self.search_dht()
         elif data.command == 'leave-dht':
             self.leave_dht()
         elif data.command == 'deregister':
             self.deregister()
         elif data.command == 'teardown-dht':
             self.teardown_dht()
+        elif data.command == 'rebalance-dht':
+            self.rebalance_dht(**data.args.__dict__)
+        elif data.command == 'node-failed':
+            self.node_failed(**data.args.__dict__)
+
+    def update_ring(self, ring, weights, bloom, *ops):
+        '''
+        Records the users of a newly built or rebuilt DHT and starts a new epoch. Users
+        reported failed are left out of the ring and purged, whether or not a repair
+        around them got through.
+
+        Parameters
+        ----------
+        ring : list
+            user_names of the users in the DHT ordered by their id.
+        weights : dict
+            Maps the user_name of each user in the DHT to its number of virtual nodes.
+        bloom : utils.BloomFilter.BloomFilter or None
+            Filter over every key in the DHT.
+        ops : tuple
+            Other operations committed in the same transition.
+        '''
+        ring = [name for name in ring if name not in self.failed]
+        self.commit(('set', 'ring', ring), ('set', 'weights', weights), ('set', 'epoch', self.epoch + 1),
+                    ('set', 'bloom', bloom), *ops, *[('pop', 'users', name) for name in self.failed],
+                    *[('pop', 'state', name) for name in self.failed])
+        self.hash_ring = HashRing(ring, weights) if ring else None
+        self.failed, self.failed_at = set(), None
 
     def register(self, user_name, port):
         '''
@@ -168,8 +271,7 @@ class Server:
                 if self.users[name].__getattribute__(field) == user.__getattribute__(field):
                     return self.failure()
         # User is unique and valid, add to registered users
-        self.users[user_name] = user
-        self.state[user_name] = FREE
+        self.commit(('put', 'users', user_name, user), ('put', 'state', user_name, FREE))
         self.success()
         print(f'Successfully registered user: {user}')
 
@@ -177,7 +279,8 @@ class Server:
         '''
         Handles request for setting up a new dht. Assigns user's new roles. Sends
         back these new rules to the leader for them to finish the setup. Then waits
-        for the leader to give an all clear before accepting any other commands.
+        for the leader to give an all clear before accepting any other commands. Nothing
+        is recorded if the setup didn't reach every user.
 
         Parameters
         ----------
@@ -187,23 +290,35 @@ class Server:
         leader = self.lookup()
         if (self.users.get(leader) is None or n < 2 or len(self.users) < n or self.num_DHTs > 0):
             return self.failure()
+        free_users = [user for user in self.state if self.state[user] == FREE and user != leader]
+        if len(free_users) < n - 1:
+            return self.failure()
         # Begin setup of DHT
-        self.state[leader] = LEADER
-        dht_users = [leader]
-        for _ in range(1, n):
-            random_free_user = random.choice([user for user in self.state if self.state[user] == FREE])
-            dht_users.append(random_free_user)
-            self.state[random_free_user] = IN_DHT
-        self.num_DHTs += 1
+        dht_users = [leader] + random.sample(free_users, n - 1)
         self.success(body=[self.users[user] for user in dht_users])
-        # Wait for Leader to send dht-complete
-        self.wait_until(command='dht-complete', user=leader)
+        # Wait for Leader to send dht-complete, nothing else is handled until then so
+        # the whole setup is logged as one transition
+        data = self.wait_until(command='dht-complete', user=leader)
+        if not data.args.built:
+            print(f'Setup of DHT with {dht_users} did not reach every user')
+            return
+        self.update_ring(dht_users, data.args.weights, data.args.bloom, ('put', 'state', leader, LEADER),
+                         *[('put', 'state', user, IN_DHT) for user in dht_users[1:]],
+                         ('set', 'num_DHTs', self.num_DHTs + 1))
         print(f'Successfully built DHT with {dht_users}')
 
-    def query_dht(self):
+    def query_dht(self, key_hash, epoch=None):
         '''
-        If the user is able to query, this will send back a random user that the
-        query will start at.
+        If the user is able to query, this will send back the user that owns key_hash
+        so the query starts where it is answered and never passes along the ring. The
+        DHT's bloom filter is sent along if the user's copy is from an older epoch.
+
+        Parameters
+        ----------
+        key_hash : int
+            Hash of the Long Name being queried.
+        epoch : int (optional)
+            Epoch of the user's copy of the bloom filter.
         '''
         if self.num_DHTs == 0:
             return self.failure()
@@ -211,14 +326,28 @@ class Server:
         if user is None or self.state[user] != FREE:
             return self.failure()
         # User is authorized to issue a query
-        random_user = random.choice([user for user in self.state if self.state[user] != FREE])
-        self.success(self.users[random_user])
+        entry_user = self.ring[self.hash_ring.owner(key_hash)]
+        bloom = self.bloom if epoch != self.epoch else None
+        self.success(sn(user=self.users[entry_user], epoch=self.epoch, bloom=bloom))
+
+    def search_dht(self):
+        '''
+        If the user is able to search, this will send back every user in the DHT
+        so the search can be broadcast to all of them, along with the user's own
+        registration so results can be sent to the address we see them at.
+        '''
+        if self.num_DHTs == 0:
+            return self.failure()
+        user = self.lookup()
+        if user is None or self.state[user] != FREE:
+            return self.failure()
+        self.success(sn(users=[self.users[user] for user in self.ring], user=self.users[user]))
 
     def leave_dht(self):
         '''
         If the user is allowed to leave the DHT it will tell them. Wait for a signal
         that the new DHT is built then will update states of the new leader and the
-        user that left.
+        user that left. Nothing changes if the rebuild didn't reach every user.
         '''
         state_values = list(self.state.values())
         if self.num_DHTs == 0 or state_values.count(LEADER) + state_values.count(IN_DHT) <= 2:
@@ -230,9 +359,13 @@ class Server:
         self.success()
         # Wait for confirmation DHT is rebuilt
         data = self.wait_until(command='dht-rebuilt', user=user)
+        if not data.args.rebuilt:
+            print(f'{user} could not leave, the rebuilt DHT did not reach every user')
+            return
         # Update state
-        self.state[user] = FREE
-        self.state[self.lookup(data.args.leader)] = LEADER
+        i = self.ring.index(user)
+        self.update_ring(self.ring[i+1:] + self.ring[:i], data.args.weights, data.args.bloom,
+                         ('put', 'state', user, FREE), ('put', 'state', self.lookup(data.args.leader), LEADER))
         print(f'{user} successfully left the DHT')
 
     def deregister(self):
@@ -244,8 +377,7 @@ class Server:
         if user is None or self.state[user] != FREE:
             return self.failure()
         # Delete user's state information
-        self.users.pop(user)
-        self.state.pop(user)
+        self.commit(('pop', 'users', user), ('pop', 'state', user))
         self.success()
         print(f'Successfully purged user {user}')
 
@@ -253,7 +385,8 @@ class Server:
         '''
         If the user is able to teardown the DHT then it tells the user. Then it
         waits for signal that the teardown is complete before setting all users
-        to be free.
+        to be free. If it didn't reach every user the DHT is kept so the leader can
+        try again.
         '''
         if self.num_DHTs == 0:
             return self.failure()
@@ -262,17 +395,89 @@ class Server:
         if user is None or self.state[user] != LEADER:
             return self.failure()
         self.success()
-        self.wait_until(command='teardown-complete', user=user)
+        data = self.wait_until(command='teardown-complete', user=user)
+        if not data.args.torn_down:
+            print(f'Teardown did not reach every user')
+            return
         # Free all users and decrement the number of DHTs
-        for user in self.state:
-            self.state[user] = FREE
-        self.num_DHTs -= 1
+        self.update_ring([], {}, None, *[('put', 'state', user, FREE) for user in self.state],
+                         ('set', 'num_DHTs', self.num_DHTs - 1))
         print(f'Successfully deleted DHT')
 
+    def rebalance_dht(self, user_name, vnodes):
+        '''
+        If the user is the leader and user_name is in the DHT it tells the leader to
+        go ahead. Then it waits for the DHT to be rebuilt with the new weights, which
+        are kept only if the rebuild reached every user.
+
+        Parameters
+        ----------
+        user_name : str
+            Name of the user to reweight.
+        vnodes : int
+            New number of virtual nodes of the user.
+        '''
+        if self.num_DHTs == 0 or user_name not in self.weights or vnodes < 1:
+            return self.failure()
+        user = self.lookup()
+        # Verify user is registered and the leader
+        if user is None or self.state[user] != LEADER:
+            return self.failure()
+        self.success()
+        data = self.wait_until(command='dht-rebuilt', user=user)
+        if not data.args.rebuilt:
+            print(f'Rebalance of {user_name} did not reach every user')
+            return
+        # Only keys moved, so the bloom filter still covers them all
+        self.update_ring(self.ring, data.args.weights, self.bloom)
+        print(f'Successfully rebalanced {user_name} to {vnodes} vnodes')
+
+    def node_failed(self, failed):
+        '''
+        Handles a report that a user in the DHT stopped sending heartbeats. Only the
+        first user after the failed one that hasn't failed itself may report it. The
+        reporter is sent the ring and every user reported failed, and told to repair
+        the ring around all of them. Once it's re-linked the failed users are purged.
+        If the re-link didn't reach everyone the failed users are kept for the next
+        repair, so two failures at once don't block each other. The reporter is also
+        told how long ago the first of them was reported, so the recovery time it
+        prints covers every attempt.
+
+        Parameters
+        ----------
+        failed : __main__.User
+            The user that stopped sending heartbeats.
+        '''
+        reporter = self.lookup()
+        user = self.lookup(failed)
+        if self.num_DHTs == 0 or reporter not in self.ring or user not in self.ring or reporter in self.failed:
+            return self.failure()
+        alive = [name for name in self.ring if name not in self.failed or name == user]
+        i = alive.index(user)
+        if alive[(i+1) % len(alive)] != reporter:
+            return self.failure()
+        self.failed.add(user)
+        if self.failed_at is None:
+            self.failed_at = time.time()
+        self.success(sn(users=[self.users[name] for name in self.ring],
+                        failed=[self.users[name] for name in self.failed], weights=self.weights,
+                        waited=time.time() - self.failed_at))
+        # Wait for the ring to be re-linked without the failed users
+        data = self.wait_until(command='repair-complete', user=reporter)
+        if not data.args.relinked:
+            print(f'Repair around {sorted(self.failed)} did not reach every user')
+            return
+        failed, elapsed = sorted(self.failed), time.time() - self.failed_at
+        ring = [name for name in self.ring if name not in self.failed]
+        self.update_ring(ring, data.args.weights, self.bloom, ('put', 'state', ring[0], LEADER))
+        print(f'Repaired DHT around {failed} in {elapsed:.3f}s')
 
 FREE = 'Free'
 IN_DHT = 'InDHT'
 LEADER = 'Leader'
+BUF_SIZE = 65507
+COMPACT_EVERY = 1000
+LOGGED_STATE = ('users', 'state', 'num_DHTs', 'ring', 'weights', 'epoch', 'bloom')
 MAX_PORT = 65535
 MAX_USR_LEN = 15
 SUCCESS = 'SUCCESS'
@@ -283,9 +488,11 @@ if __name__ == '__main__':
     # Useage: python3 server.py --port 25565
     parser = argparse.ArgumentParser(description='Server process that tracks the state of clients')
 
-    parser.add_argument('--port', '-p',     type=int,
-                                            default=25565,
-                                            help='port to listen on.')
+    parser.add_argument('--port', '-p',         type=int,
+                                                default=25565,
+                                                help='port to listen on.')
+    parser.add_argument('--state_dir', '-s',    default=join(dirname(getcwd()), 'state'),
+                                                help='directory to keep the write-ahead log in.')
 
     args = parser.parse_args()
     Server(**args.__dict__)
@@ -0,0 +1,62 @@
+from hashlib import sha256
+
+
+class BloomFilter:
+    '''
+    Custom implementation of a bloom filter over string keys. A key that was added
+    is always reported as present, a key that was never added is reported as
+    present with a small false positive rate.
+
+    Attributes
+    ----------
+    size : int
+        Number of bits in the filter.
+    num_hashes : int
+        Number of bits set for each key.
+    bits : int
+        The bits of the filter.
+    '''
+
+    def __init__(self, size, num_hashes):
+        self.size = size
+        self.num_hashes = num_hashes
+        self.bits = 0
+
+    def __repr__(self):
+        return f'BloomFilter(size={self.size}, num_hashes={self.num_hashes})'
+
+    def __contains__(self, key):
+        return all(self.bits >> i & 1 for i in self.indexes(key))
+
+    def indexes(self, key):
+        '''
+        Computes the bits a key maps to using double hashing. Uses sha256 rather
+        than hash() so that every process maps a key to the same bits.
+
+        Parameters
+        ----------
+        key : str
+            key to be hashed.
+
+        Returns
+        -------
+        list
+            index of each bit the key maps to.
+        '''
+        digest = sha256(bytearray(key, 'utf-8')).digest()
+        h1 = int.from_bytes(digest[:8], 'big')
+        h2 = int.from_bytes(digest[8:16], 'big') | 1
+        return [(h1 + i*h2) % self.size for i in range(self.num_hashes)]
+
+    def add(self, key):
+        '''
+        Adds a key to the filter.
+
+        Parameters
+        ----------
+        key : str
+            key to be added.
+        '''
+        for i in self.indexes(key):
+            self.bits |= 1 << i
+
@@ -0,0 +1,65 @@
+from bisect import bisect
+from hashlib import sha256
+
+
+class HashRing:
+    '''
+    Custom implementation of consistent hashing with virtual nodes. Each user is
+    placed on the ring at as many points as its weight, a key belongs to the user
+    at the first point after the key's hash. Giving a user more virtual nodes gives
+    it a larger share of the keys. At least one virtual node is required.
+
+    Attributes
+    ----------
+    points : list
+        Sorted hashes of every virtual node on the ring.
+    owners : list
+        owners[j] is the id of the user placed at points[j].
+    '''
+
+    def __init__(self, user_names, weights):
+        placed = sorted((self.hash_func(f'{user_name}#{v}'), i)
+                        for i, user_name in enumerate(user_names) for v in range(weights[user_name]))
+        if not placed:
+            raise ValueError('HashRing needs at least one virtual node')
+        self.points = [point for point, _ in placed]
+        self.owners = [i for _, i in placed]
+
+    def __repr__(self):
+        return str(list(zip(self.points, self.owners)))
+
+    @staticmethod
+    def hash_func(key):
+        return int.from_bytes(sha256(bytearray(key, 'utf-8')).digest()[:8], 'big')
+
+    def owner(self, key_hash):
+        '''
+        Finds the user that owns a hash.
+
+        Parameters
+        ----------
+        key_hash : int
+            Hash of a key computed with self.hash_func.
+
+        Returns
+        -------
+        int
+            id of the user owning the hash.
+        '''
+        return self.owners[bisect(self.points, key_hash) % len(self.points)]
+
+    def lookup(self, key):
+        '''
+        Finds the user that owns a key.
+
+        Parameters
+        ----------
+        key : str
+            key to lookup.
+
+        Returns
+        -------
+        int
+            id of the user owning the key.
+        '''
+        return self.owner(self.hash_func(key))
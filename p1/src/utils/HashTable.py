@@ -18,6 +18,12 @@ class HashTable:
     def __repr__(self):
         return str(self.table)
 
+    def __len__(self):
+        return sum(entry.record is not None for entry in self.table)
+
+    def __iter__(self):
+        return (entry.record for entry in self.table if entry.record is not None)
+
     def hash_func(self, key):
         return sum(bytearray(key, 'utf-8')) % self.size
 
@@ -0,0 +1,114 @@
+from bisect import bisect_left
+from bisect import insort
+from heapq import nsmallest
+
+
+class PrefixIndex:
+    '''
+    Sorted array of keys supporting prefix and fuzzy search. Keys are compared
+    without case. Prefix matches are found by binary search, fuzzy matches by
+    comparing the query against every key.
+
+    Attributes
+    ----------
+    keys : list
+        Sorted (lowercase key, key) tuples.
+    '''
+
+    def __init__(self):
+        self.keys = []
+
+    def __repr__(self):
+        return str([key for _, key in self.keys])
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, key):
+        '''
+        Adds a key to the index if it isn't already there.
+
+        Parameters
+        ----------
+        key : str
+            key to be added.
+        '''
+        entry = (key.lower(), key)
+        i = bisect_left(self.keys, entry)
+        if i == len(self.keys) or self.keys[i] != entry:
+            insort(self.keys, entry)
+
+    def remove(self, key):
+        '''
+        Removes a key from the index if it is there.
+
+        Parameters
+        ----------
+        key : str
+            key to be removed.
+        '''
+        entry = (key.lower(), key)
+        i = bisect_left(self.keys, entry)
+        if i < len(self.keys) and self.keys[i] == entry:
+            del self.keys[i]
+
+    def search(self, query, limit, max_distance):
+        '''
+        Finds the keys closest to query. A key's distance is the edit distance between
+        query and the start of the key, or the whole key if that is closer, so keys
+        starting with query have a distance of 0. If there are enough of those the
+        fuzzy comparison is skipped.
+
+        Parameters
+        ----------
+        query : str
+            Prefix or misspelling of a key.
+        limit : int
+            Maximum number of keys to return.
+        max_distance : int
+            Keys further than this from query are not returned.
+
+        Returns
+        -------
+        list
+            Up to limit (distance, key) tuples, closest first.
+        '''
+        query = query.lower()
+        matches = []
+        i = bisect_left(self.keys, (query,))
+        while i < len(self.keys) and self.keys[i][0].startswith(query) and len(matches) < limit:
+            matches.append((0, self.keys[i][1]))
+            i += 1
+        if len(matches) == limit:
+            return matches
+        # Not enough keys start with query, look for near misses
+        matches = []
+        for lower_key, key in self.keys:
+            distance = min(edit_distance(query, lower_key[:len(query)]), edit_distance(query, lower_key))
+            if distance <= max_distance:
+                matches.append((distance, key))
+        return nsmallest(limit, matches)
+
+
+def edit_distance(a, b):
+    '''
+    Levenshtein distance between two strings.
+
+    Parameters
+    ----------
+    a : str
+        First string.
+    b : str
+        Second string.
+
+    Returns
+    -------
+    int
+        Fewest insertions, deletions and substitutions turning a into b.
+    '''
+    row = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        prev_diag, row[0] = row[0], i
+        for j in range(1, len(b) + 1):
+            prev_diag, row[j] = row[j], min(row[j] + 1, row[j-1] + 1, prev_diag + (a[i-1] != b[j-1]))
+    return row[-1]
@@ -0,0 +1,171 @@
+import os
+import pickle
+
+from _thread import start_new_thread
+from os.path import exists
+from os.path import join
+
+
+class StateLog:
+    '''
+    Append-only write-ahead log of state transitions. Each record is a list of
+    operations applied together with apply_op. Records are written to numbered
+    segment files. Compaction starts a new segment, then writes a snapshot of the
+    live state in a background thread and deletes the segments it covers. Appends
+    can continue while the snapshot is written. Recovery loads the snapshot and
+    replays only the segments written after it.
+
+    Attributes
+    ----------
+    path : str
+        Directory holding the snapshot and segment files.
+    compact_every : int
+        Number of records appended before the log should be compacted.
+    segment : int
+        Number of the segment being appended to.
+    records : int
+        Number of records appended since the last compaction.
+    compacting : bool
+        True while a snapshot is being written.
+    file : io.BufferedWriter or None
+        The open segment file.
+    '''
+
+    def __init__(self, path, compact_every):
+        self.path = path
+        self.compact_every = compact_every
+        self.segment = 0
+        self.records = 0
+        self.compacting = False
+        self.file = None
+        os.makedirs(path, exist_ok=True)
+
+    def segments(self):
+        '''
+        Returns
+        -------
+        list
+            Numbers of the segment files on disk, in order.
+        '''
+        return sorted(int(name.split('.')[1]) for name in os.listdir(self.path) if name.startswith('log.'))
+
+    def load(self):
+        '''
+        Reads the snapshot and every record written after it, then opens a new segment
+        to append to. A record torn by a crash ends its segment.
+
+        Returns
+        -------
+        dict or None
+            Snapshot of the state, None if there isn't one.
+        list
+            Records written since the snapshot, in order.
+        '''
+        state, first = None, 0
+        if exists(join(self.path, 'snapshot')):
+            with open(join(self.path, 'snapshot'), 'rb') as f:
+                first, state = pickle.load(f)
+        records = []
+        for segment in self.segments():
+            if segment < first:
+                continue
+            with open(join(self.path, f'log.{segment}'), 'rb') as f:
+                while True:
+                    try:
+                        records.append(pickle.load(f))
+                    except (EOFError, pickle.UnpicklingError):
+                        break
+        self.records = len(records)
+        self.open_segment(max(self.segments(), default=first - 1) + 1)
+        return state, records
+
+    def open_segment(self, segment):
+        '''
+        Closes the current segment file and starts appending to a new one.
+
+        Parameters
+        ----------
+        segment : int
+            Number of the new segment.
+        '''
+        if self.file is not None:
+            self.file.close()
+        self.segment = segment
+        self.file = open(join(self.path, f'log.{segment}'), 'ab')
+
+    def append(self, record):
+        '''
+        Durably appends a record to the current segment.
+
+        Parameters
+        ----------
+        record : list
+            Operations to be applied together.
+        '''
+        pickle.dump(record, self.file)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.records += 1
+
+    def compact(self, state):
+        '''
+        Starts a new segment, then writes the snapshot in a background thread. Does
+        nothing if a snapshot is already being written.
+
+        Parameters
+        ----------
+        state : dict
+            Copy of the live state as of the end of the current segment.
+        '''
+        if self.compacting:
+            return
+        self.compacting = True
+        self.open_segment(self.segment + 1)
+        self.records = 0
+        start_new_thread(self.write_snapshot, (self.segment, state))
+
+    def write_snapshot(self, segment, state):
+        '''
+        Atomically replaces the snapshot, then deletes the segments it covers. If the
+        snapshot can't be written the segments are kept and a later compaction tries again.
+
+        Parameters
+        ----------
+        segment : int
+            First segment not covered by the snapshot.
+        state : dict
+            Copy of the live state as of the start of segment.
+        '''
+        tmp_path = join(self.path, 'snapshot.tmp')
+        try:
+            with open(tmp_path, 'wb') as f:
+                pickle.dump((segment, state), f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, join(self.path, 'snapshot'))
+            for old_segment in self.segments():
+                if old_segment < segment:
+                    os.remove(join(self.path, f'log.{old_segment}'))
+        finally:
+            self.compacting = False
+
+
+def apply_op(obj, op):
+    '''
+    Applies a logged operation to obj. Operations are ('set', attr, value),
+    ('put', attr, key, value) and ('pop', attr, key), where attr names an
+    attribute of obj and put and pop act on the dict it holds.
+
+    Parameters
+    ----------
+    obj : object
+        Object holding the state.
+    op : tuple
+        The operation to apply.
+    '''
+    if op[0] == 'set':
+        setattr(obj, op[1], op[2])
+    elif op[0] == 'put':
+        getattr(obj, op[1])[op[2]] = op[3]
+    elif op[0] == 'pop':
+        getattr(obj, op[1]).pop(op[2], None)